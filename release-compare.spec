@@ -26,6 +26,8 @@ Source:         %name-%version.tar.xz
 BuildArch:      noarch
 Requires:       python3-PyYAML
 Requires:       python3-setuptools
+Recommends:     python3-lxml
+Recommends:     python3-orjson
 BuildRequires:  python3-pytest
 BuildRequires:  python3-PyYAML
 BuildRequires:  python3-setuptools
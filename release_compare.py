@@ -17,8 +17,10 @@
 # write to the Free Software Foundation, Inc., 59 Temple Place,
 # Suite 330, Boston, MA  02111-1307, USA
 import argparse
-import difflib
+import concurrent.futures
+import functools
 import glob
+import io
 import json
 import logging
 import os
@@ -26,11 +28,23 @@ import pathlib
 import re
 import shutil
 import subprocess
+import tarfile
 import tempfile
-import textwrap
+import threading
 import traceback
 import yaml
-import xml.etree.ElementTree as ET
+try:
+    from lxml import etree as ET
+except ImportError:
+    import xml.etree.ElementTree as ET
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    from yaml import CSafeLoader as YamlLoader, CSafeDumper as YamlDumper
+except ImportError:
+    from yaml import SafeLoader as YamlLoader, SafeDumper as YamlDumper
 from setuptools._vendor.packaging import version as pkg_version
 from urllib.parse import urlparse
 
@@ -41,6 +55,19 @@ LOG = None
 CONFIG = None
 ROOT = None
 
+EMAIL_RE = re.compile(r'\* .*@.*')
+CVE_RE = re.compile(r'CVE-[0-9]{4}-[0-9]+')
+VERSION_RE = re.compile(r'(-)([0-9]+(\.[0-9]+)+)(-)')
+BUILD_RE = re.compile(r'(Build)([0-9]+(\.[0-9]+)?)')
+IMAGE_BUILD_RE = re.compile(r'(Build)([0-9]+(\.[0-9]+)?)?')
+# matching in a regex string, so we need to match escapes as well, hence
+# all the backslashes
+ESCAPED_VERSION_RE = re.compile(r'-[0-9]+(\\\.[0-9]+)+\\-')
+
+# {pkg_root: {filename: path}}, filled on first lookup of a package root
+PKG_INDEX = {}
+PKG_INDEX_LOCK = threading.Lock()
+
 
 class Config:
     def __init__(self, config_file):
@@ -86,6 +113,7 @@ class PackageInfo:
         self.arch = arch
         self.source = source
         self.repo = repo
+        self._src_name = None
 
     def __eq__(self, s):
         return self.name == s
@@ -97,6 +125,11 @@ class PackageInfo:
         return self.name
 
     def get_src_name(self):
+        if self._src_name is None:
+            self._src_name = self._parse_src_name()
+        return self._src_name
+
+    def _parse_src_name(self):
         # source URL format is obs://build.suse.de/SUSE:PROJECT:SUB/repo/hash-pkg_name[.maint_prj]
         # .maint_prj is only there when PROJECT is a maintenance project
         # since package names may contain dots, simply cutting off trailing '\..*' is not an option
@@ -126,27 +159,45 @@ class PackageInfo:
             # instead of guessing the real project name, we just scan the whole
             # tree for the package with the right name. There should be only
             # one anyway.
-            pkg_path = next(pathlib.Path(pkg_root).rglob(filename_long), None)
+            pkg_index = get_pkg_index(pkg_root)
+            pkg_path = pkg_index.get(filename_long)
             if not pkg_path:
                 # appliance build in OBS uses short format
-                pkg_path = next(pathlib.Path(pkg_root).rglob(filename_short), None)
-            if pkg_path:
-                pkg_path = str(pkg_path)
+                pkg_path = pkg_index.get(filename_short)
         else:
-            pkg_path = os.path.join(pkg_root, self.repo, filename_long)
-            if not os.path.exists(pkg_path):
-                pkg_path = os.path.join(pkg_root, self.repo, filename_short)
-            if not os.path.exists(pkg_path):
-                pkg_path = None
+            pkg_path = None
+            for filename in (filename_long, filename_short):
+                candidate = os.path.join(pkg_root, self.repo, filename)
+                if os.path.isfile(candidate):
+                    pkg_path = candidate
+                    break
         return pkg_path
 
 
+def get_pkg_index(pkg_root):
+    # walking the tree once and looking packages up by file name is much
+    # cheaper than searching the whole tree again for every package
+    with PKG_INDEX_LOCK:
+        if pkg_root not in PKG_INDEX:
+            pkg_index = {}
+            for dirpath, dirnames, filenames in os.walk(pkg_root):
+                for filename in filenames:
+                    pkg_index.setdefault(filename, os.path.join(dirpath, filename))
+            PKG_INDEX[pkg_root] = pkg_index
+        return PKG_INDEX[pkg_root]
+
+
 def get_packages_from_report_file(report_file):
-    tree = ET.parse(report_file)
-    root = tree.getroot()
     pkgs = []
 
-    for item in root.findall('./binary'):
+    # report files of full distribution builds can be huge, so the
+    # elements are processed and dropped one by one
+    root = None
+    for event, item in ET.iterparse(report_file, events=('start', 'end')):
+        if root is None:
+            root = item
+        if event != 'end' or item.tag != 'binary':
+            continue
         pkg_name = item.get('name')
         if pkg_name:
             repo=None
@@ -162,37 +213,39 @@ def get_packages_from_report_file(report_file):
                     repo=repo
                 )
             )
+        item.clear()
+        if hasattr(item, 'getprevious'):
+            # lxml: detach the siblings processed before this one
+            while item.getprevious() is not None:
+                del item.getparent()[0]
+        else:
+            root.clear()
 
     return pkgs
 
 
 def get_packages_from_packages_file(packages_file):
     pkgs = []
-    line_no = 0
-
-    with open(packages_file, 'r') as ins:
-        line = ins.readline()
-        while line:
-            records = line.split('|')
-            line_no += 1
-            try:
-                if records[5] == '(none)' or records[5] == '':
-                    LOG.debug('ignoring package "{}", no source information'.format(records[0]))
-                else:
-                    pkgs.append(
-                        PackageInfo(
-                            name=records[0],
-                            version=records[2],
-                            release=records[3],
-                            arch=records[4],
-                            source=records[5]
-                        )
-                    )
-            except IndexError:
+
+    with open(packages_file, 'r', buffering=256*1024) as ins:
+        for line_no, line in enumerate(ins, 1):
+            records = line.rstrip('\n').split('|', 6)
+            if len(records) < 6:
                 LOG.warn('line no {} in {} does not have expected format, skipping'.format(
                     line_no, packages_file)
                 )
-            line = ins.readline()
+            elif records[5] == '(none)' or records[5] == '':
+                LOG.debug('ignoring package "{}", no source information'.format(records[0]))
+            else:
+                pkgs.append(
+                    PackageInfo(
+                        name=records[0],
+                        version=records[2],
+                        release=records[3],
+                        arch=records[4],
+                        source=records[5]
+                    )
+                )
 
     return pkgs
 
@@ -208,53 +261,87 @@ def get_packages_from_file(data_file):
 
 def write_pkg_info(pkg, outdir):
     rpm = pkg.get_path(os.path.join(ROOT, 'SOURCES', 'repos'))
-    if not rpm or not os.path.exists(rpm):
+    if not rpm:
         LOG.warning('could not find rpm for package "{}", skipping'.format(pkg.name))
     else:
-        rpm_src_name = pkg.get_src_name()
-        with open(os.path.join(outdir, 'changelogs', rpm_src_name), 'w', encoding='UTF-8') as outf:
-            subprocess.Popen(
-                [
-                    'rpm', '-qp', rpm, '--changelog', '--nodigest', '--nosignature'
-                ],
-                env={'LC_ALL': 'C.UTF-8'},
-                stdout=outf
-            )
         with open(os.path.join(outdir, 'rpms', pkg.name), 'w') as outf:
             outf.write('{}-{}'.format(pkg.version, pkg.release))
 
 
+def write_pkg_changelog(pkg, outdir, changelog, src_name=None):
+    # reuse the change log read by get_pkg_changelog rather than
+    # querying the rpm a second time
+    if changelog is None:
+        # rpm not found, get_pkg_changelog already warned about it
+        return
+    rpm_src_name = src_name or pkg.get_src_name()
+    with open(os.path.join(outdir, 'changelogs', rpm_src_name), 'w', encoding='UTF-8') as outf:
+        outf.writelines(line + '\n' for line in changelog)
+
+
+def get_src_pkgs(pkgs):
+    # RPM change logs are identical for all sub packages
+    # so we store and diff them based on source packages names,
+    # using the first sub package whose rpm can actually be found
+    pkg_root = os.path.join(ROOT, 'SOURCES', 'repos')
+    src_pkgs = {}
+    found = set()
+    for pkg in pkgs:
+        src_name = pkg.get_src_name()
+        if src_name in found:
+            continue
+        # keep the first one if no rpm is found at all, so this gets reported
+        src_pkgs.setdefault(src_name, pkg)
+        if pkg.get_path(pkg_root):
+            src_pkgs[src_name] = pkg
+            found.add(src_name)
+    return src_pkgs
+
+
 def get_pkg_changelog(pkg):
+    src_name = pkg.get_src_name()
     rpm = pkg.get_path(os.path.join(ROOT, 'SOURCES', 'repos'))
-    if not rpm or not os.path.exists(rpm):
+    if not rpm:
         LOG.warning('could not find rpm for package "{}", cannot read changelog'.format(pkg.name))
-        return None
+        return src_name, None
     else:
-        proc = subprocess.Popen(
+        proc = subprocess.run(
             [
                 'rpm', '-qp', rpm, '--changelog', '--nodigest', '--nosignature'
             ],
             env={'LC_ALL': 'C.UTF-8'},
-            stdout=subprocess.PIPE
+            stdout=subprocess.PIPE,
+            check=False
         )
-        return [x.decode('utf-8').rstrip('\n') for x in proc.stdout.readlines()]
+        # split on newlines only, parse_old_obsgendiff reads the change
+        # logs of released obsgendiffs back the same way
+        lines = proc.stdout.decode('utf-8').split('\n')
+        if lines[-1] == '':
+            lines.pop()
+        return src_name, lines
 
 
-def get_matching_files(search_dir, regex):
-    match_re = re.compile(regex)
-    files = os.listdir(search_dir)
-    matches = []
-    for f in files:
-        if match_re.fullmatch(f):
-            matches.append(f)
-    return matches
+@functools.lru_cache(maxsize=256)
+def get_compiled_regex(regex):
+    return re.compile(regex)
+
+
+def get_source_files():
+    try:
+        with os.scandir(os.path.join(ROOT, 'SOURCES')) as entries:
+            return [entry.name for entry in entries]
+    except FileNotFoundError:
+        return []
+
+
+def get_matching_files(files, regex):
+    match_re = get_compiled_regex(regex)
+    return [f for f in files if match_re.fullmatch(f)]
 
 
 def get_latest_obsgendiff_version(filenames):
     if len(filenames) == 1:
         return filenames[0]
-    version_re = re.compile(r'(-)([0-9]+(\.[0-9]+)+)(-)')
-    build_re = re.compile(r'(Build)([0-9]+(\.[0-9]+)?)')
     last_version = pkg_version.Version('0.0.0')
     last_build = pkg_version.Version('0.0')
     latest = None
@@ -263,8 +350,8 @@ def get_latest_obsgendiff_version(filenames):
         LOG.debug('  considering {}'.format(f))
         cur_version = 0
         cur_build = 0
-        version_match = version_re.search(f)
-        build_match = build_re.search(f)
+        version_match = VERSION_RE.search(f)
+        build_match = BUILD_RE.search(f)
         if version_match:
             cur_version = pkg_version.parse(version_match.group(2))
         if build_match:
@@ -280,9 +367,9 @@ def get_latest_obsgendiff_version(filenames):
     return latest
 
 
-def extract_old_obsgendiff(report_file, outdir):
+def find_old_obsgendiff(report_file, source_files=None):
     image_name_full = pathlib.Path(report_file).stem
-    build_match = re.search(r'(Build)([0-9]+(\.[0-9]+)?)?', image_name_full)
+    build_match = IMAGE_BUILD_RE.search(image_name_full)
     if build_match:
         obsgendiff_regex = r'{}Build[0-9]+(\.[0-9]+){}.obsgendiff'.format(
             re.escape(image_name_full[:build_match.start()]),
@@ -308,21 +395,21 @@ def extract_old_obsgendiff(report_file, outdir):
             )
             return None
     LOG.debug('using regex "{}" to select old obsgendiff'.format(obsgendiff_regex))
-    src_matches = get_matching_files(os.path.join(ROOT, 'SOURCES'), obsgendiff_regex)
+    if source_files is None:
+        source_files = get_source_files()
+    src_matches = get_matching_files(source_files, obsgendiff_regex)
     if not src_matches:
         LOG.debug(
             'no old obsgendiff found for "{}", trying for older versions'.format(image_name_full)
         )
-        # matching in a regex string, so we need to match escapes as well, hence
-        # all the backslashes
-        version_match = re.search(r'-[0-9]+(\\\.[0-9]+)+\\-', obsgendiff_regex)
+        version_match = ESCAPED_VERSION_RE.search(obsgendiff_regex)
         if version_match:
             obsgendiff_regex = r'{}-[0-9]+(\.[0-9]+)+-{}'.format(
                 obsgendiff_regex[:version_match.start()],
                 obsgendiff_regex[version_match.end():]
             )
             LOG.debug('using regex "{}" to select old obsgendiff'.format(obsgendiff_regex))
-            src_matches = get_matching_files(os.path.join(ROOT, 'SOURCES'), obsgendiff_regex)
+            src_matches = get_matching_files(source_files, obsgendiff_regex)
         else:
             LOG.warning('no version number found in "{}"'.format(image_name_full))
             return None
@@ -330,16 +417,19 @@ def extract_old_obsgendiff(report_file, outdir):
     if not obsgendiff:
         LOG.warning('no old obsgendiff found for "{}"'.format(image_name_full))
         return None
-    extract_dir = os.path.join(outdir, 'obsgendiff.released')
-    os.mkdir(extract_dir)
-    LOG.info('extracting {}'.format(obsgendiff))
-    subprocess.call(['tar', 'xf', os.path.join(ROOT, 'SOURCES', obsgendiff), '-C', extract_dir])
-    return os.path.join(outdir, extract_dir)
+    return os.path.join(ROOT, 'SOURCES', obsgendiff)
+
 
+def load_yaml(stream):
+    # same as yaml.safe_load, but using libyaml if available
+    return yaml.load(stream, Loader=YamlLoader)
 
-def load_file(input_file, loader):
+
+def load_file(input_file, loader, stream=None):
     try:
-        with open(input_file, 'r') as inf:
+        if stream is None:
+            stream = open(input_file, 'r')
+        with stream as inf:
             return loader(inf)
     except Exception as error:
         LOG.warning('error loading {} ({})'.format(input_file, str(error)))
@@ -348,60 +438,99 @@ def load_file(input_file, loader):
         return None
 
 
-def parse_old_obsgendiff(report_file, tmpdir):
-    extract_path = extract_old_obsgendiff(report_file, tmpdir)
-    if not extract_path:
+def parse_old_obsgendiff(report_file, source_files=None):
+    obsgendiff = find_old_obsgendiff(report_file, source_files)
+    if not obsgendiff:
         return [], {}, None
     pkgs = []
     changelogs = {}
-    rpms = os.listdir(os.path.join(extract_path, 'rpms'))
-
-    for rpm in rpms:
-        with open(os.path.join(extract_path, 'rpms', rpm), 'r') as in_file:
-            fullver = in_file.read()
-        pkgs.append(PackageInfo(rpm, *fullver.split('-')))
+    histories = {}
+    history_loaders = {
+        'image_changes.json': json.load,
+        'image_changes.yaml': load_yaml
+    }
 
-    changes_files = os.listdir(os.path.join(extract_path, 'changelogs'))
-    for changes_file in changes_files:
-        with open(os.path.join(extract_path, 'changelogs', changes_file),
-                  'r', encoding='utf-8') as in_file:
-            changelogs[changes_file] = [x.rstrip('\n') for x in in_file.readlines()]
+    # read the members in a single pass over the archive,
+    # no need to unpack it first
+    LOG.info('reading {}'.format(obsgendiff))
+    with tarfile.open(obsgendiff, 'r:*') as tar:
+        for member in tar:
+            if not member.isfile():
+                continue
+            parts = pathlib.PurePosixPath(member.name).parts
+            if len(parts) == 2 and parts[0] == 'rpms':
+                fullver = tar.extractfile(member).read().decode()
+                pkgs.append(PackageInfo(parts[1], *fullver.split('-')))
+            elif len(parts) == 2 and parts[0] == 'changelogs':
+                # split on newlines only, the same way the rpm output is split
+                with io.TextIOWrapper(
+                    tar.extractfile(member), encoding='utf-8', newline='\n'
+                ) as in_file:
+                    changelogs[parts[1]] = [x.rstrip('\n') for x in in_file.readlines()]
+            elif len(parts) == 1 and parts[0] in history_loaders:
+                histories[parts[0]] = load_file(
+                    '{}:{}'.format(obsgendiff, member.name),
+                    history_loaders[parts[0]],
+                    tar.extractfile(member)
+                )
 
     history = None
-    history_file = os.path.join(extract_path, 'image_changes.json')
-    loader = json.load
-    if not os.path.exists(history_file):
-        history_file = os.path.join(extract_path, 'image_changes.yaml')
-        loader = yaml.safe_load
-    if not os.path.exists(history_file):
-        LOG.warning('No image version history in old obsgendiff')
+    for history_file in history_loaders:
+        if history_file in histories:
+            history = histories[history_file]
+            break
     else:
-        history = load_file(history_file, loader)
+        LOG.warning('No image version history in old obsgendiff')
     return pkgs, changelogs, history
 
 
+def split_changelog(changes):
+    # every change log entry starts with a '* <date> <author>' line
+    entries = []
+    for line in changes:
+        if line.startswith('* ') or not entries:
+            entries.append([])
+        entries[-1].append(line)
+    return entries
+
+
+def get_entry_key(entry):
+    # the last entry of a change log lacks the trailing blank line
+    # the other entries have, so ignore those for comparison
+    end = len(entry)
+    while end and not entry[end - 1]:
+        end -= 1
+    return tuple(entry[:end])
+
+
+def get_added_lines(changes_old, changes_current):
+    # rather than diffing line by line, compare whole entries, that also
+    # picks up entries that were not added at the top (e.g. backports)
+    old_entries = {get_entry_key(entry) for entry in split_changelog(changes_old)}
+    added = []
+    for entry in split_changelog(changes_current):
+        if get_entry_key(entry) not in old_entries:
+            added.extend(entry)
+    return added
+
+
 def compare_changelogs(changes_old, changes_current):
     if not changes_old or not changes_current:
         # unless there was a problem with package query or with
         # the old obsgendiff, this should not happen
-        return 'n/a'
-    differ = difflib.Differ()
+        return 'n/a', set()
     changes = ''
-    delta = differ.compare(changes_old, changes_current)
+    cve_refs = set()
 
     if CONFIG.anonymize_changes:
-        email_re = re.compile(r'\+ \* .*@.*')
+        email_re = EMAIL_RE
     else:
         email_re = None
-    for line in delta:
-        if line.startswith('+ '):
-            if not email_re or not email_re.match(line):
-                changes += line[2:] + '\n'
-        else:
-            # stop once we've reached the first line that is not an addition
-            # existing change log entries are not supposed to be altered anyway
-            break
-    return changes.rstrip('\n')
+    for line in get_added_lines(changes_old, changes_current):
+        if not email_re or not email_re.match(line):
+            changes += line + '\n'
+            cve_refs.update(CVE_RE.findall(line))
+    return changes.rstrip('\n'), cve_refs
 
 
 def get_changelog_data(new_pkgs, new_changelogs, old_pkgs, old_changelogs):
@@ -438,20 +567,22 @@ def get_changelog_data(new_pkgs, new_changelogs, old_pkgs, old_changelogs):
 
     # diff package changelogs and generate list of CVEs
     cve_refs = set()
-    cve_re = re.compile(r'CVE-[0-9]{4}-[0-9]+')
     for clog in common_logs:
-        changes = compare_changelogs(old_changelogs[clog], new_changelogs[clog])
+        changes_old = old_changelogs[clog]
+        changes_current = new_changelogs[clog]
+        if changes_old and changes_old == changes_current:
+            # most packages did not change at all, no need to diff those
+            continue
+        changes, cve_matches = compare_changelogs(changes_old, changes_current)
         if changes:
             cl_dict['source-changes'][clog] = changes
-            cve_matches = cve_re.findall(changes)
-            for cve_match in cve_matches:
-                cve_refs.add(cve_match)
+            cve_refs.update(cve_matches)
     cl_dict['references'] = sorted(cve_refs)
     return cl_dict
 
 
 def write_changelog_text(output_file, changelog):
-    with open(output_file, 'w', encoding='utf-8') as outf:
+    with open(output_file, 'w', encoding='utf-8', buffering=1 << 20) as outf:
         outf.write('Removed rpms\n')
         outf.write('============\n')
         if changelog.get('removed'):
@@ -468,7 +599,7 @@ def write_changelog_text(output_file, changelog):
             outf.write('\n')
             for src_name, changes in changelog['source-changes'].items():
                 print(src_name, file=outf)
-                outf.write(textwrap.indent(changes, '+ ', lambda line: True))
+                outf.write('+ ' + changes.replace('\n', '\n+ '))
                 outf.write('\n')
         outf.write('\nReferences\n')
         outf.write('==========\n')
@@ -478,13 +609,20 @@ def write_changelog_text(output_file, changelog):
 
 
 def write_changelog_yaml(output_file, changelog):
+    # serialize first and write the result in one go
+    data = yaml.dump(changelog, Dumper=YamlDumper, default_flow_style=False, sort_keys=False)
     with open(output_file, 'w') as outf:
-        yaml.dump(changelog, outf, default_flow_style=False, sort_keys=False)
+        outf.write(data)
 
 
 def write_changelog_json(output_file, changelog):
-    with open(output_file, 'w') as outf:
-        json.dump(changelog, outf, indent=2, sort_keys=False)
+    # serialize first and write the result in one go
+    if orjson:
+        data = orjson.dumps(changelog, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS)
+    else:
+        data = json.dumps(changelog, indent=2, sort_keys=False, ensure_ascii=False).encode('utf-8')
+    with open(output_file, 'wb') as outf:
+        outf.write(data)
 
 
 def match_changes_file(image_name, sources_dir):
@@ -511,7 +649,7 @@ def get_config_changes(new_history_file, old_history):
     if new_history_file.endswith('.json'):
         loader = json.load
     elif new_history_file.endswith('.yaml'):
-        loader = yaml.safe_load
+        loader = load_yaml
     else:
         LOG.warning('unknown format "{}", cannot parse image history')
         return {}
@@ -525,6 +663,20 @@ def get_config_changes(new_history_file, old_history):
     return config_changes
 
 
+def get_files_by_suffix(search_dir, suffix):
+    # same result as glob '<search_dir>/*<suffix>' for plain files,
+    # without going through fnmatch for every entry
+    try:
+        with os.scandir(search_dir) as entries:
+            return [
+                entry.path for entry in entries
+                if entry.name.endswith(suffix) and not entry.name.startswith('.')
+                and entry.is_file()
+            ]
+    except FileNotFoundError:
+        return []
+
+
 def create_changelog(root) -> None:
     global ROOT
     global CONFIG
@@ -538,13 +690,19 @@ def create_changelog(root) -> None:
     logging.basicConfig(level=log_level, format='%(name)s:[%(levelname)s] %(message)s')
     LOG = logging.getLogger('create_changelog')
 
-    report_files = glob.glob(os.path.join(ROOT, 'OTHER', '*.report'))
-    report_files += glob.glob(os.path.join(ROOT, 'KIWI', '*.packages'))
-    report_files += glob.glob(os.path.join(ROOT, 'DOCKER', '*.packages'))
-    report_files += glob.glob(os.path.join(ROOT, 'PRODUCT', '*.report'))
+    report_files = get_files_by_suffix(os.path.join(ROOT, 'OTHER'), '.report')
+    report_files += get_files_by_suffix(os.path.join(ROOT, 'KIWI'), '.packages')
+    report_files += get_files_by_suffix(os.path.join(ROOT, 'DOCKER'), '.packages')
+    report_files += get_files_by_suffix(os.path.join(ROOT, 'PRODUCT'), '.report')
 
     os.makedirs(os.path.join(ROOT, 'OTHER'), exist_ok=True)
 
+    # drop package tree indexes left over from earlier runs, the tree is
+    # only indexed again here if a package without repo info needs it
+    PKG_INDEX.clear()
+    # the released obsgendiffs of all reports are looked up in SOURCES
+    source_files = get_source_files()
+
     for report in report_files:
         if '-Media2' in report or '-Media3' in report or '-Debug' in report or '-Source' in report:
             # skip source and debug media
@@ -552,15 +710,11 @@ def create_changelog(root) -> None:
 
         LOG.info('parsing {}'.format(report))
         pkgs = get_packages_from_file(report)
-        pkg_changelogs = {}
         image_name = pathlib.Path(report).stem
 
-        for pkg in pkgs:
-            # RPM change logs are identical for all sub packages
-            # so we store and diff them based on source packages names
-            src_name = pkg.get_src_name()
-            if not pkg_changelogs.get(src_name):
-                pkg_changelogs[src_name] = get_pkg_changelog(pkg)
+        unique_pkgs = get_src_pkgs(pkgs)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+            pkg_changelogs = dict(executor.map(get_pkg_changelog, unique_pkgs.values()))
 
         history_file = match_changes_file(image_name, os.path.join(ROOT, 'SOURCES'))
         image_net_new = False
@@ -572,6 +726,10 @@ def create_changelog(root) -> None:
 
             for pkg in pkgs:
                 write_pkg_info(pkg, tmpdir)
+            # one change log per source package is enough, written from
+            # the same sub package get_src_pkgs picked for reading it
+            for src_name, pkg in unique_pkgs.items():
+                write_pkg_changelog(pkg, tmpdir, pkg_changelogs[src_name], src_name)
 
             if history_file:
                 shutil.copyfile(
@@ -583,13 +741,17 @@ def create_changelog(root) -> None:
 
             obsgendiff = os.path.join(ROOT, 'OTHER', image_name + '.obsgendiff')
             LOG.info('creating obsgendiff {}'.format(obsgendiff))
-            subprocess.call(['tar', 'cfJ', obsgendiff, '-C', tmpdir, '.'])
+            # let xz compress on all available cores
+            subprocess.call([
+                'tar', '-c', '-f', obsgendiff, '--use-compress-program=xz -T0 -6',
+                '-C', tmpdir, '.'
+            ])
 
             (
                 released_pkgs,
                 released_changelogs,
                 released_history
-            ) = parse_old_obsgendiff(report, tmpdir)
+            ) = parse_old_obsgendiff(report, source_files)
             changelog_name = 'ChangeLog.' + image_name
             changelog_data = {}
 
@@ -1,11 +1,20 @@
 from unittest.mock import patch, Mock
-import filecmp
+import io
+import shutil
+import tarfile
 import os
 import pathlib
-import tempfile
-import yaml
-import json
+import pytest
 import release_compare
+try:
+    from orjson import loads as _json_loads
+except ImportError:
+    from json import loads as _json_loads
+from yaml import load as yaml_load
+try:
+    from yaml import CSafeLoader as _Loader
+except ImportError:
+    from yaml import SafeLoader as _Loader
 
 new_changelog1 = """\
 * Wed Mar 1 2023 somebody@somewhere.com
@@ -70,109 +79,250 @@ img_history = {
   ]
 }
 
-new_changelog_dict = {
-  'package1': new_changelog1.splitlines(),
-  'package2': new_changelog2.splitlines(),
-  'package3': new_changelog3.splitlines()
-}
+# split once at import and shared by all tests
+_NEW_CL1 = tuple(new_changelog1.splitlines())
+_NEW_CL2 = tuple(new_changelog2.splitlines())
+_NEW_CL3 = tuple(new_changelog3.splitlines())
+_OLD_CL1 = old_changelog1.splitlines()
+
+data_dir = os.path.normpath(os.path.join(os.path.dirname(__file__), '..', 'data'))
+KIWI_DIR = os.path.join(data_dir, 'input', 'KIWI')
+REPORT_PATH = os.path.join(KIWI_DIR, 'foo-os.x86_64-1.0.12-profile1-Build.report')
+PACKAGES_PATH = os.path.join(KIWI_DIR, 'foo-os.x86_64-1.0.12-profile1-Build.packages')
+
+# expected results, read once at import
+with open(os.path.join(data_dir, 'output', 'ChangeLog.txt'), 'r') as inf:
+    EXPECTED_TXT = inf.read()
+with open(os.path.join(data_dir, 'output', 'ChangeLog.json'), 'rb') as inf:
+    EXPECTED_JSON = _json_loads(inf.read())
+with open(os.path.join(data_dir, 'output', 'ChangeLog.yaml'), 'r') as inf:
+    EXPECTED_YAML = yaml_load(inf, Loader=_Loader)
+
+
+@pytest.fixture(scope='session')
+def report_path():
+    return REPORT_PATH
+
+
+@pytest.fixture(scope='session')
+def packages_path():
+    return PACKAGES_PATH
+
+
+@pytest.fixture(scope='session')
+def report_pkgs(report_path):
+    return release_compare.get_packages_from_file(report_path)
+
+
+@pytest.fixture(scope='session')
+def packages_pkgs(packages_path):
+    return release_compare.get_packages_from_file(packages_path)
+
+
+@pytest.fixture(scope='module')
+def new_changelog_dict():
+    return {
+      'package1': list(_NEW_CL1),
+      'package2': list(_NEW_CL2),
+      'package3': list(_NEW_CL3)
+    }
+
+
+@pytest.fixture(scope='session')
+def old_obs(packages_path):
+    # parse_old_obsgendiff looks the archive up below ROOT and logs through LOG
+    release_compare.LOG = Mock()
+    release_compare.ROOT = os.path.join(data_dir, 'input')
+    return release_compare.parse_old_obsgendiff(packages_path)
+
+
+@pytest.fixture
+def work_dirs(tmp_path):
+    (tmp_path / 'changelogs').mkdir()
+    (tmp_path / 'rpms').mkdir()
+    return tmp_path
 
-data_dir = os.path.join(str(pathlib.Path(__file__).parent), '../data')
 
+@pytest.mark.parametrize('fname', [
+    'foo-os.x86_64-1.0.12-profile1-Build.report',
+    'foo-os.x86_64-1.0.12-profile1-Build.packages'
+])
+def test_get_packages_from_file(fname):
+    assert release_compare.get_packages_from_file(
+        os.path.join(KIWI_DIR, fname)
+    ) == ['package1', 'package2', 'package3']
 
-def test_get_packages_from_file():
-    pkgs = release_compare.get_packages_from_file(
-        os.path.join(data_dir, 'input', 'KIWI', 'foo-os.x86_64-1.0.12-profile1-Build.report')
+
+def test_get_path(report_pkgs, packages_pkgs):
+    pkg_root = os.path.join(data_dir, 'input', 'SOURCES', 'repos')
+    assert packages_pkgs[0].get_path(pkg_root) == os.path.join(
+        pkg_root, 'standard', 'standard', 'package1-1.2.3-1.2.x86_64.rpm'
+    )
+    assert packages_pkgs[1].get_path(pkg_root) is None
+
+    assert report_pkgs[0].get_path(pkg_root) == os.path.join(
+        pkg_root, 'standard', 'standard', 'package1-1.2.3-1.2.x86_64.rpm'
     )
-    assert pkgs == ['package1', 'package2', 'package3']
+    assert report_pkgs[1].get_path(pkg_root) is None
+
 
-    pkgs = release_compare.get_packages_from_file(
-        os.path.join(data_dir, 'input', 'KIWI', 'foo-os.x86_64-1.0.12-profile1-Build.packages')
+def test_get_src_pkgs(report_pkgs):
+    release_compare.ROOT = os.path.join(data_dir, 'input')
+    # first sub package of the source is missing in SOURCES/repos
+    missing = release_compare.PackageInfo(
+        'package1-sub', '1.2.3', '1.2', 'x86_64',
+        source=report_pkgs[0].source, repo=report_pkgs[0].repo
     )
-    assert pkgs == ['package1', 'package2', 'package3']
+    src_pkgs = release_compare.get_src_pkgs([missing, report_pkgs[0], report_pkgs[2]])
+    assert src_pkgs['package1'] is report_pkgs[0]
+    # no rpm found at all, the first sub package is kept
+    assert src_pkgs['package3'] is report_pkgs[2]
 
 
-@patch('release_compare.subprocess.Popen')
-def test_write_pkg_info(mock_subprocess):
+def test_write_pkg_info(report_pkgs, work_dirs):
     release_compare.CONFIG = release_compare.Config('')
-    with tempfile.TemporaryDirectory() as tmpdir:
-        release_compare.ROOT = os.path.join(data_dir, 'input')
-        os.mkdir(os.path.join(tmpdir, 'changelogs'))
-        os.mkdir(os.path.join(tmpdir, 'rpms'))
-        pkgs = release_compare.get_packages_from_file(
-            os.path.join(data_dir, 'input', 'KIWI', 'foo-os.x86_64-1.0.12-profile1-Build.report')
-        )
-        release_compare.write_pkg_info(pkgs[0], tmpdir)
-        with open(os.path.join(tmpdir, 'rpms', 'package1')) as inf:
-            assert inf.read() == '1.2.3-1.2'
-
-
-def test_parse_old_obsgendiff():
-    release_compare.LOG = Mock()
-    with tempfile.TemporaryDirectory() as tmpdir:
-        pkgs, changelogs, history = release_compare.parse_old_obsgendiff(
-            os.path.join(
-                data_dir, 'input', 'KIWI',
-                'foo-os.x86_64-1.0.12-profile1-Build.packages'
-            ),
-            tmpdir
-        )
+    release_compare.ROOT = os.path.join(data_dir, 'input')
+    tmpdir = str(work_dirs)
+    release_compare.write_pkg_info(report_pkgs[0], tmpdir)
+    assert pathlib.Path(tmpdir, 'rpms', 'package1').read_text() == '1.2.3-1.2'
+
+
+@patch('release_compare.subprocess.run')
+def test_get_pkg_changelog(mock_run, report_pkgs):
+    release_compare.ROOT = os.path.join(data_dir, 'input')
+    mock_run.return_value = Mock(stdout=b'* Wed Mar 1 2023 a@b.c\n- form\x0cfeed\n')
+    assert release_compare.get_pkg_changelog(report_pkgs[0]) == (
+        'package1', ['* Wed Mar 1 2023 a@b.c', '- form\x0cfeed']
+    )
+
+
+def test_write_pkg_changelog(report_pkgs, work_dirs):
+    tmpdir = str(work_dirs)
+    release_compare.write_pkg_changelog(report_pkgs[0], tmpdir, _NEW_CL1)
+    assert pathlib.Path(tmpdir, 'changelogs', 'package1').read_text() == new_changelog1
+
+
+def test_parse_old_obsgendiff(old_obs):
+    pkgs, changelogs, history = old_obs
     assert 'package0' in pkgs
     assert 'package1' in pkgs
     assert 'package2' in pkgs
-    assert changelogs['package1'] == old_changelog1.splitlines()
+    assert changelogs['package1'] == _OLD_CL1
     assert history == img_history
 
 
-def test_write_changelog():
-    new_pkgs = release_compare.get_packages_from_file(
-        os.path.join(data_dir, 'input', 'KIWI', 'foo-os.x86_64-1.0.12-profile1-Build.packages')
+def test_parse_old_obsgendiff_newlines(tmp_path):
+    release_compare.LOG = Mock()
+    release_compare.CONFIG = release_compare.Config('')
+    release_compare.ROOT = str(tmp_path)
+    (tmp_path / 'SOURCES').mkdir()
+    data = '* Wed Mar 1 2023 a@b.c\n- carriage\rreturn\n'.encode()
+    obsgendiff = tmp_path / 'SOURCES' / 'foo-os.x86_64-1.0.12-profile1-Build1.23.obsgendiff'
+    with tarfile.open(obsgendiff, 'w:xz') as tar:
+        member = tarfile.TarInfo('./changelogs/package1')
+        member.size = len(data)
+        tar.addfile(member, io.BytesIO(data))
+    pkgs, changelogs, history = release_compare.parse_old_obsgendiff(
+        str(tmp_path / 'KIWI' / 'foo-os.x86_64-1.0.12-profile1-Build.packages')
     )
+    assert changelogs['package1'] == ['* Wed Mar 1 2023 a@b.c', '- carriage\rreturn']
+
+
+def test_compare_changelogs():
+    release_compare.LOG = Mock()
+    release_compare.CONFIG = release_compare.Config('')
+    added = '* Wed Mar 1 2023 somebody@somewhere.com\n- some other changes CVE-2022-1234'
+    assert release_compare.compare_changelogs(
+        _OLD_CL1, _NEW_CL1
+    ) == ('- some other changes CVE-2022-1234', {'CVE-2022-1234'})
     release_compare.CONFIG.anonymize_changes = False
-    with tempfile.TemporaryDirectory() as tmpdir:
-        old_pkgs, old_logs, old_history = release_compare.parse_old_obsgendiff(
-            os.path.join(
-                data_dir, 'input', 'KIWI',
-                'foo-os.x86_64-1.0.12-profile1-Build.packages'
-            ),
-            tmpdir
-        )
-
-        changelog_data = release_compare.get_changelog_data(
-            new_pkgs, new_changelog_dict, old_pkgs, old_logs
-        )
-        new_history_file = release_compare.match_changes_file(
-            'foo-os.x86_64-1.0.12-profile1-Build',
-            os.path.join(data_dir, 'input', 'SOURCES')
-        )
-        changelog_data['config-changes'] = release_compare.get_config_changes(
-            new_history_file, old_history
-        )
-
-        release_compare.write_changelog_text(
-            os.path.join(tmpdir, 'ChangeLog.txt'), changelog_data
-        )
-        release_compare.write_changelog_json(
-            os.path.join(tmpdir, 'ChangeLog.json'), changelog_data
-        )
-        release_compare.write_changelog_yaml(
-            os.path.join(tmpdir, 'ChangeLog.yaml'), changelog_data
-        )
-
-        assert open(os.path.join(tmpdir, 'ChangeLog.txt'), 'r').read() == open(os.path.join(data_dir, 'output', 'ChangeLog.txt'), 'r').read()
-        assert filecmp.cmp(
-            os.path.join(tmpdir, 'ChangeLog.txt'),
-            os.path.join(data_dir, 'output', 'ChangeLog.txt')
-        )
-        # compare yaml and json content rather than verbatim
-        # change in order is ok
-        with open(os.path.join(tmpdir, 'ChangeLog.json'), 'r') as inf:
-            generated_data = json.load(inf)
-        with open(os.path.join(data_dir, 'output', 'ChangeLog.json'), 'r') as inf:
-            expected_data = json.load(inf)
-        assert generated_data == expected_data
-
-        with open(os.path.join(tmpdir, 'ChangeLog.yaml'), 'r') as inf:
-            generated_data = yaml.safe_load(inf)
-        with open(os.path.join(data_dir, 'output', 'ChangeLog.yaml'), 'r') as inf:
-            expected_data = yaml.safe_load(inf)
-        assert generated_data == expected_data
+    assert release_compare.compare_changelogs(
+        _OLD_CL1, _NEW_CL1
+    ) == (added, {'CVE-2022-1234'})
+    # current change log trimmed at the end
+    assert release_compare.compare_changelogs(
+        _OLD_CL1, _NEW_CL1[:-3]
+    ) == (added, {'CVE-2022-1234'})
+    # entry added below already released entries
+    backport = ['* Sun Feb 26 2023 somebody@somewhere.com', '- backport CVE-2022-4321', '']
+    new_lines = list(_NEW_CL1)
+    assert release_compare.compare_changelogs(
+        _OLD_CL1, new_lines[:6] + backport + new_lines[6:]
+    ) == (
+        added + '\n\n' + '\n'.join(backport[:2]),
+        {'CVE-2022-1234', 'CVE-2022-4321'}
+    )
+    assert release_compare.compare_changelogs(
+        [], _NEW_CL1
+    ) == ('n/a', set())
+
+
+def test_write_changelog(new_changelog_dict, packages_pkgs, old_obs, tmp_path):
+    release_compare.LOG = Mock()
+    release_compare.CONFIG = release_compare.Config('')
+    release_compare.CONFIG.anonymize_changes = False
+    tmpdir = str(tmp_path)
+    old_pkgs, old_logs, old_history = old_obs
+
+    changelog_data = release_compare.get_changelog_data(
+        packages_pkgs, new_changelog_dict, old_pkgs, old_logs
+    )
+    new_history_file = release_compare.match_changes_file(
+        'foo-os.x86_64-1.0.12-profile1-Build',
+        os.path.join(data_dir, 'input', 'SOURCES')
+    )
+    changelog_data['config-changes'] = release_compare.get_config_changes(
+        new_history_file, old_history
+    )
+
+    release_compare.write_changelog_text(
+        os.path.join(tmpdir, 'ChangeLog.txt'), changelog_data
+    )
+    release_compare.write_changelog_json(
+        os.path.join(tmpdir, 'ChangeLog.json'), changelog_data
+    )
+    release_compare.write_changelog_yaml(
+        os.path.join(tmpdir, 'ChangeLog.yaml'), changelog_data
+    )
+
+    with open(os.path.join(tmpdir, 'ChangeLog.txt'), 'r') as inf:
+        assert inf.read() == EXPECTED_TXT
+    # compare yaml and json content rather than verbatim
+    # change in order is ok
+    with open(os.path.join(tmpdir, 'ChangeLog.json'), 'rb') as inf:
+        assert _json_loads(inf.read()) == EXPECTED_JSON
+    with open(os.path.join(tmpdir, 'ChangeLog.yaml'), 'r') as inf:
+        assert yaml_load(inf, Loader=_Loader) == EXPECTED_YAML
+
+
+@patch('release_compare.subprocess.run')
+def test_create_changelog(mock_run, tmp_path):
+    mock_run.return_value = Mock(stdout=new_changelog1.encode())
+    root = tmp_path / 'root'
+    shutil.copytree(os.path.join(data_dir, 'input'), root)
+    packages_file = root / 'KIWI' / 'foo-os.x86_64-1.0.12-profile1-Build.packages'
+    # first sub package of package1 has no rpm in SOURCES/repos
+    packages_file.write_text(
+        'package1-sub|(none)|1.2.3|1.2|x86_64|obs://build.host/standard/12345678-package1|'
+        'license\n' + packages_file.read_text()
+    )
+    release_compare.create_changelog(str(root))
+
+    obsgendiff = root / 'OTHER' / 'foo-os.x86_64-1.0.12-profile1-Build.obsgendiff'
+    with tarfile.open(obsgendiff) as tar:
+        assert './changelogs/package1' in tar.getnames()
+    changelog = (root / 'OTHER' / 'ChangeLog.foo-os.x86_64-1.0.12-profile1-Build.txt').read_text()
+    assert '+ - some other changes CVE-2022-1234' in changelog
+    assert ' - CVE-2022-1234' in changelog
+
+
+def test_create_changelog_no_sources(tmp_path):
+    (tmp_path / 'KIWI').mkdir()
+    release_compare.create_changelog(str(tmp_path))
+    assert os.listdir(tmp_path / 'OTHER') == []
+
+
+def test_write_changelog_json_utf8(tmp_path):
+    output_file = tmp_path / 'ChangeLog.json'
+    release_compare.write_changelog_json(str(output_file), {'added': ['für']})
+    assert output_file.read_bytes() == '{\n  "added": [\n    "für"\n  ]\n}'.encode('utf-8')